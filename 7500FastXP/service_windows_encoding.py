@@ -1,68 +1,230 @@
 import win32service
 import win32serviceutil
 import win32event
+import win32file
+import win32con
+import pywintypes
+import winerror
 import time
 import os
-import glob
+import stat
 import struct
 import hashlib
-from asn1crypto.core import Sequence, OctetString, UTF8String
+import collections
 
 # Folders and device names
 WATCH_FOLDER = r"C:\watched"
 PROCESSED_FOLDER = os.path.join(WATCH_FOLDER, "processed")
 SERIAL_PORT = r"\\.\Global\attestation_channel" 
 
-# ASN.1 FileContainer definition: a SEQUENCE with two fields.
-class FileContainer(Sequence):
-    _fields = [
-        ('filename', UTF8String),
-        ('data', OctetString)
-    ]
+# Access right needed to read change notifications on a directory handle.
+FILE_LIST_DIRECTORY = 0x0001
 
-def create_file_container(filename, data):
+# Size of the buffer receiving ReadDirectoryChangesW notifications.
+CHANGE_BUFFER_SIZE = 8192
+
+# How often files still held open by their writer are checked again.
+BUSY_RETRY_INTERVAL_MS = 1000
+
+# Bloom filter over processed file hashes: 1 MiB of bits, 3 bit positions per hash.
+BLOOM_FILTER_BITS = 8 * 1024 * 1024
+BLOOM_HASH_COUNT = 3
+
+# Number of most recently processed hashes kept for exact lookups.
+RECENT_HASHES_MAX = 10000
+
+# FileContainer framing: filename length (2 bytes) and data length (4 bytes),
+# both big-endian, followed by the UTF-8 filename and the file data.
+FILE_CONTAINER_HEADER = struct.Struct("!HI")
+
+# Serial message framing: 4-byte big-endian container length, then the FileContainer.
+MESSAGE_PREFIX = struct.Struct("!I")
+
+def read_file_message(file_path, filename):
+    """
+    Read a file into a complete serial message: the length prefix followed by
+    a FileContainer holding the filename and file data. The file is read
+    straight into its place in one preallocated buffer, so the message is
+    built without intermediate copies. Returns the message and the data length.
+    """
+    name = filename.encode("utf-8")
+    with open(file_path, "rb", buffering=0) as f:
+        data_length = os.fstat(f.fileno()).st_size
+        data_offset = MESSAGE_PREFIX.size + FILE_CONTAINER_HEADER.size + len(name)
+        message = bytearray(data_offset + data_length)
+        MESSAGE_PREFIX.pack_into(message, 0, len(message) - MESSAGE_PREFIX.size)
+        FILE_CONTAINER_HEADER.pack_into(message, MESSAGE_PREFIX.size, len(name), data_length)
+        message[data_offset - len(name):data_offset] = name
+        view = memoryview(message)
+        offset = data_offset
+        while offset < len(message):
+            n = f.readinto(view[offset:])
+            if not n:
+                raise IOError("File {} shrank while being read".format(file_path))
+            offset += n
+        view.release()
+    return message, data_length
+
+# Chunk size used when streaming a file through the hash.
+HASH_CHUNK_SIZE = 1 << 20
+
+def hash_file(file_path):
+    """
+    Return the hex SHA-256 digest of a file, streaming it in fixed-size chunks
+    so the whole file is never held in memory.
+    """
+    with open(file_path, "rb", buffering=0) as f:
+        # hashlib.file_digest (Python 3.11+) runs the same loop in C.
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
+        buf = bytearray(HASH_CHUNK_SIZE)
+        mv = memoryview(buf)
+        for n in iter(lambda: f.readinto(mv), 0):
+            h.update(mv[:n])
+        return h.hexdigest()
+
+def stat_file(file_path):
+    """Return the stat() result for a regular file, or None if it is missing or not a file."""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+def scan_folder(folder):
+    """
+    Return (path, stat) pairs for the regular files directly inside folder.
+    os.scandir (Python 3.5+) gets the file type from the directory listing itself.
+    """
+    if hasattr(os, "scandir"):
+        return [(entry.path, entry.stat()) for entry in os.scandir(folder)
+                if entry.is_file(follow_symlinks=False)]
+    files = []
+    for name in os.listdir(folder):
+        file_path = os.path.join(folder, name)
+        st = stat_file(file_path)
+        if st is not None:
+            files.append((file_path, st))
+    return files
+
+def file_in_use(file_path):
+    """
+    Return True if another process still has the file open, i.e. it is still
+    being written. Opening with share mode 0 fails with a sharing violation
+    while any other handle to the file exists.
+    """
+    try:
+        handle = win32file.CreateFile(
+            file_path, win32con.GENERIC_READ, 0, None, win32con.OPEN_EXISTING, 0, None)
+    except pywintypes.error as e:
+        if e.winerror == winerror.ERROR_SHARING_VIOLATION:
+            return True
+        raise
+    handle.Close()
+    return False
+
+class ProcessedFiles(object):
     """
-    Build and return a DER-encoded FileContainer containing the filename and file data.
+    Bounded-memory set of processed file hashes. A bloom filter rejects most
+    unseen hashes, the most recent hashes are kept exactly, and the rare bloom
+    hit outside that window is confirmed against the on-disk log, so lookups
+    never report a file as processed when it was not.
     """
-    container = FileContainer({
-        'filename': filename,
-        'data': data
-    })
-    return container.dump()
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.bloom = bytearray(BLOOM_FILTER_BITS // 8)
+        self.recent = collections.OrderedDict()
+
+    def _bits(self, file_hash):
+        # The hash is already uniformly distributed, so its slices serve as the bloom hashes.
+        return [int(file_hash[i * 8:(i + 1) * 8], 16) % BLOOM_FILTER_BITS
+                for i in range(BLOOM_HASH_COUNT)]
+
+    def add(self, file_hash):
+        for bit in self._bits(file_hash):
+            self.bloom[bit >> 3] |= 1 << (bit & 7)
+        self.recent[file_hash] = True
+        self.recent.move_to_end(file_hash)
+        if len(self.recent) > RECENT_HASHES_MAX:
+            self.recent.popitem(last=False)
+
+    def __contains__(self, file_hash):
+        for bit in self._bits(file_hash):
+            if not self.bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        if file_hash in self.recent:
+            return True
+        try:
+            with open(self.log_path, "r") as f:
+                return any(line.strip() == file_hash for line in f)
+        except IOError:
+            return False
 
 class XPFileMonitorService(win32serviceutil.ServiceFramework):
     _svc_name_ = "XPFileMonitorService"
     _svc_display_name_ = "XP File Monitor Service"
     _svc_description_ = ("Monitors a folder for new files and sends each file's name and data "
-                         "to the Linux control server over the virtio-serial channel using a DER-encoded container.")
+                         "to the Linux control server over the virtio-serial channel using a length-prefixed container.")
 
     def __init__(self, args):
         win32serviceutil.ServiceFramework.__init__(self, args)
         self.hWaitStop = win32event.CreateEvent(None, 0, 0, None)
         self.running = True
         self.processed_files_path = r"C:\list_of_signed_results.txt"
+        self.hash_cache_path = r"C:\list_of_hashed_files.txt"
+        self.processed_log = None
 
     def load_processed_files(self):
-        """Load the set of processed file hashes from disk."""
-        processed_files = set()
+        """Load the processed file hashes from the on-disk log."""
+        processed_files = ProcessedFiles(self.processed_files_path)
         try:
             if os.path.exists(self.processed_files_path):
                 with open(self.processed_files_path, "r") as f:
-                    processed_files = set(line.strip() for line in f)
+                    for line in f:
+                        file_hash = line.strip()
+                        if file_hash:
+                            processed_files.add(file_hash)
         except Exception as e:
             with open(r"C:\XPFileMonitorService.log", "a") as log:
                 log.write("Error loading processed files: {}\n".format(e))
         return processed_files
 
-    def save_processed_files(self, processed_files):
-        """Save the set of processed file hashes to disk."""
+    def append_processed_file(self, file_hash):
+        """Append a single processed file hash to the on-disk log."""
+        try:
+            if self.processed_log is None:
+                self.processed_log = open(self.processed_files_path, "a", buffering=65536)
+            self.processed_log.write("{}\n".format(file_hash))
+            self.processed_log.flush()
+        except Exception as e:
+            with open(r"C:\XPFileMonitorService.log", "a") as log:
+                log.write("Error appending processed file: {}\n".format(e))
+
+    def load_hash_cache(self):
+        """Load the (path, size, mtime_ns) -> digest cache from disk."""
+        hash_cache = {}
         try:
-            with open(self.processed_files_path, "w") as f:
-                for file_hash in processed_files:
-                    f.write("{}\n".format(file_hash))
+            if os.path.exists(self.hash_cache_path):
+                with open(self.hash_cache_path, "r") as f:
+                    for line in f:
+                        path, size, mtime_ns, file_hash = line.rstrip("\n").split("\t")
+                        hash_cache[(path, int(size), int(mtime_ns))] = file_hash
         except Exception as e:
             with open(r"C:\XPFileMonitorService.log", "a") as log:
-                log.write("Error saving processed files: {}\n".format(e))
+                log.write("Error loading hash cache: {}\n".format(e))
+        return hash_cache
+
+    def save_hash_cache(self, hash_cache):
+        """Save the (path, size, mtime_ns) -> digest cache to disk."""
+        try:
+            with open(self.hash_cache_path, "w") as f:
+                for (path, size, mtime_ns), file_hash in hash_cache.items():
+                    f.write("{}\t{}\t{}\t{}\n".format(path, size, mtime_ns, file_hash))
+        except Exception as e:
+            with open(r"C:\XPFileMonitorService.log", "a") as log:
+                log.write("Error saving hash cache: {}\n".format(e))
 
     def SvcStop(self):
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
@@ -75,6 +237,87 @@ class XPFileMonitorService(win32serviceutil.ServiceFramework):
             os.makedirs(PROCESSED_FOLDER)
         self.main()
 
+    def process_files(self, files, full_scan, serial_port, processed_files, hash_cache):
+        """
+        Hash the given watch folder files and send any file not processed before.
+        files holds (path, stat) pairs, with stat None for paths that are not
+        regular files. On a full scan, cache entries for every other path are dropped.
+        Returns the set of paths skipped because they are still being written.
+        """
+        new_files = []
+        busy_paths = set()
+        file_paths = set(file_path for file_path, _ in files)
+        current_keys = set()
+        cache_changed = False
+        
+        # Filter for unique files we haven't processed before
+        for file_path, st in files:
+            if st is None:
+                continue
+            # Writers create files as name.tmp and rename them once complete.
+            if file_path.lower().endswith(".tmp"):
+                continue
+            key = (file_path, st.st_size, st.st_mtime_ns)
+            current_keys.add(key)
+            file_hash = hash_cache.get(key)
+            # Unchanged files already sent need nothing beyond the stat.
+            if file_hash is not None and file_hash in processed_files:
+                continue
+            try:
+                # Skip files still being written; they are retried once released.
+                if file_in_use(file_path):
+                    busy_paths.add(file_path)
+                    continue
+                if file_hash is None:
+                    file_hash = hash_file(file_path)
+                    hash_cache[key] = file_hash
+                    cache_changed = True
+            except (pywintypes.error, EnvironmentError) as e:
+                # The file vanished or cannot be opened; skip only this file.
+                with open(r"C:\XPFileMonitorService.log", "a") as log:
+                    log.write("Error checking file {}: {}\n".format(file_path, e))
+                continue
+            if file_hash not in processed_files:
+                new_files.append((file_path, file_hash))
+
+        # Drop entries for files that have been moved, deleted or modified.
+        for key in list(hash_cache):
+            if key[0] in busy_paths:
+                continue
+            if key not in current_keys and (full_scan or key[0] in file_paths):
+                del hash_cache[key]
+                cache_changed = True
+        if cache_changed:
+            self.save_hash_cache(hash_cache)
+
+        for file_path, file_hash in new_files:
+            filename = os.path.basename(file_path)
+            try:
+                # Build the message: 4-byte length prefix (big-endian) + container.
+                message, data_length = read_file_message(file_path, filename)
+
+                # Write the message to the virtio-serial port.
+                serial_port.write(message)
+                serial_port.flush()
+
+                # Log the sent file.
+                with open(r"C:\XPFileMonitorService.log", "a") as log:
+                    log.write("Sent file: {} ({} bytes)\n".format(filename, data_length))
+
+                # Move the processed file.
+                dest_path = os.path.join(PROCESSED_FOLDER, filename)
+                os.rename(file_path, dest_path)
+                
+                # Add to processed files set and log it
+                processed_files.add(file_hash)
+                self.append_processed_file(file_hash)
+                
+            except Exception as e:
+                with open(r"C:\XPFileMonitorService.log", "a") as log:
+                    log.write("Error processing file {}: {}\n".format(filename, e))
+
+        return busy_paths
+
     def main(self):
         try:
             # Open the virtio-serial port in binary read/write mode.
@@ -84,67 +327,92 @@ class XPFileMonitorService(win32serviceutil.ServiceFramework):
                 log.write("Failed to open serial port {}: {}\n".format(SERIAL_PORT, e))
             return
 
+        try:
+            # Open the watch folder for change notifications.
+            dir_handle = win32file.CreateFile(
+                WATCH_FOLDER,
+                FILE_LIST_DIRECTORY,
+                win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE,
+                None,
+                win32con.OPEN_EXISTING,
+                win32con.FILE_FLAG_BACKUP_SEMANTICS | win32file.FILE_FLAG_OVERLAPPED,
+                None
+            )
+        except Exception as e:
+            with open(r"C:\XPFileMonitorService.log", "a") as log:
+                log.write("Failed to watch folder {}: {}\n".format(WATCH_FOLDER, e))
+            serial_port.close()
+            return
+
+        overlapped = pywintypes.OVERLAPPED()
+        overlapped.hEvent = win32event.CreateEvent(None, True, False, None)
+        change_buffer = win32file.AllocateReadBuffer(CHANGE_BUFFER_SIZE)
+
         # Load the set of previously processed files
         processed_files = self.load_processed_files()
 
+        # Digests of files already seen, keyed on their stat() signature so
+        # unchanged files are not re-read on every scan.
+        hash_cache = self.load_hash_cache()
+
+        # Pick up anything that arrived while the service was not running.
+        full_scan = True
+        read_pending = False
+
+        # Files still held open by their writer, retried until they are released.
+        busy_paths = set()
+
         while self.running:
             try:
-                # Look for files in the watch folder (ignore subdirectories).
-                files = glob.glob(os.path.join(WATCH_FOLDER, "*"))
-                new_files = []
-                
-                # Filter for unique files we haven't processed before
-                for file_path in files:
-                    if os.path.isfile(file_path):
-                        with open(file_path, "rb") as f:
-                            file_hash = hashlib.sha256(f.read()).hexdigest()
-                        if file_hash not in processed_files:
-                            new_files.append((file_path, file_hash))
-
-                if new_files:
-                    # Wait 5 seconds before processing the files
-                    time.sleep(5)
-                    
-                    for file_path, file_hash in new_files:
-                        filename = os.path.basename(file_path)
-                        try:
-                            with open(file_path, "rb") as f:
-                                file_data = f.read()
-
-                            # Create the DER-encoded file container.
-                            container_der = create_file_container(filename, file_data)
-                            container_length = len(container_der)
-
-                            # Build the message: 4-byte length prefix (big-endian) + DER data.
-                            message = struct.pack("!I", container_length) + container_der
-
-                            # Write the message to the virtio-serial port.
-                            serial_port.write(message)
-                            serial_port.flush()
-
-                            # Log the sent file.
-                            with open(r"C:\XPFileMonitorService.log", "a") as log:
-                                log.write("Sent file: {} ({} bytes)\n".format(filename, len(file_data)))
-
-                            # Move the processed file.
-                            dest_path = os.path.join(PROCESSED_FOLDER, filename)
-                            os.rename(file_path, dest_path)
-                            
-                            # Add to processed files set and save
-                            processed_files.add(file_hash)
-                            self.save_processed_files(processed_files)
-                            
-                        except Exception as e:
-                            with open(r"C:\XPFileMonitorService.log", "a") as log:
-                                log.write("Error processing file {}: {}\n".format(filename, e))
+                # Start collecting changes before any full scan, so files that
+                # arrive while the scan is running still produce a notification.
+                if not read_pending:
+                    win32file.ReadDirectoryChangesW(
+                        dir_handle,
+                        change_buffer,
+                        False,
+                        win32con.FILE_NOTIFY_CHANGE_FILE_NAME | win32con.FILE_NOTIFY_CHANGE_LAST_WRITE,
+                        overlapped
+                    )
+                    read_pending = True
+
+                if full_scan:
+                    # Look for files in the watch folder (ignore subdirectories).
+                    files = scan_folder(WATCH_FOLDER)
+                    busy_paths = self.process_files(files, True, serial_port, processed_files, hash_cache)
+                    full_scan = False
+
+                # Wait for the next change in the watch folder, or for SvcStop.
+                timeout = BUSY_RETRY_INTERVAL_MS if busy_paths else win32event.INFINITE
+                rc = win32event.WaitForMultipleObjects(
+                    [self.hWaitStop, overlapped.hEvent], False, timeout)
+                if rc == win32event.WAIT_OBJECT_0:
+                    win32file.CancelIo(dir_handle)
+                    break
+
+                file_paths = set(busy_paths)
+                if rc != win32event.WAIT_TIMEOUT:
+                    read_pending = False
+                    n_bytes = win32file.GetOverlappedResult(dir_handle, overlapped, True)
+                    if n_bytes == 0:
+                        # The notification buffer overflowed; fall back to a full scan.
+                        full_scan = True
+                        continue
+                    for _action, name in win32file.FILE_NOTIFY_INFORMATION(change_buffer, n_bytes):
+                        file_paths.add(os.path.join(WATCH_FOLDER, name))
 
-                time.sleep(30)
+                files = [(file_path, stat_file(file_path)) for file_path in sorted(file_paths)]
+                busy_paths = self.process_files(files, False, serial_port, processed_files, hash_cache)
                 
             except Exception as e:
                 with open(r"C:\XPFileMonitorService.log", "a") as log:
                     log.write("Error in main loop: {}\n".format(e))
+                full_scan = True
                 time.sleep(5)
                 
+        if self.processed_log is not None:
+            self.processed_log.close()
+        win32file.CloseHandle(dir_handle)
         serial_port.close()
 
 if __name__ == '__main__':
@@ -1,14 +1,15 @@
 import click
 import os
+import re
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional
 
-def setup_build_dir(build_dir: str) -> None:
+def setup_build_dir(build_path: Path) -> None:
     """Create build directory structure"""
     try:
-        build_path = Path(build_dir).resolve()
         Path(build_path, 'scripts', 'files').mkdir(parents=True, exist_ok=True)
     except PermissionError as e:
         raise RuntimeError(f"Unable to create build directory: {e}")
@@ -20,12 +21,29 @@ def copy_file(src: Path, dst: Path) -> None:
     except (shutil.Error, OSError) as e:
         raise RuntimeError(f"Failed to copy {src} to {dst}: {e}")
 
-def copy_scripts(src_dir: str, build_dir: str) -> None:
+# Chunk size for each os.sendfile call when copying files
+SENDFILE_CHUNK_SIZE = 1024 * 1024
+
+def sendfile_copy(src: str, dst: str) -> str:
+    """Copy a file in the kernel with os.sendfile, falling back to shutil.copy2"""
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+            offset = 0
+            while True:
+                sent = os.sendfile(dst_fd, src_fd, offset, SENDFILE_CHUNK_SIZE)
+                if sent == 0:
+                    break
+                offset += sent
+        shutil.copystat(src, dst)
+        return dst
+    except (AttributeError, OSError):
+        # os.sendfile is missing or cannot write to regular files on this platform
+        return shutil.copy2(src, dst)
+
+def copy_scripts(src_path: Path, build_path: Path) -> None:
     """Copy scripts and their files to build directory"""
     try:
-        src_path = Path(src_dir).resolve()
-        build_path = Path(build_dir).resolve()
-        
         # Copy shell scripts to scripts directory
         shutil.copytree(src_path, build_path / 'scripts',
                        dirs_exist_ok=True,
@@ -34,27 +52,12 @@ def copy_scripts(src_dir: str, build_dir: str) -> None:
         # Copy files directory separately
         src_files = src_path / 'files'
         if src_files.exists():
-            shutil.copytree(src_files, build_path / 'files', dirs_exist_ok=True)
+            shutil.copytree(src_files, build_path / 'files', dirs_exist_ok=True,
+                           copy_function=sendfile_copy)
             
     except Exception as e:
         raise RuntimeError(f"Failed to copy scripts and files: {e}")
 
-def clean_scripts(build_dir: str) -> None:
-    """Remove specified lines from shell scripts"""
-    patterns = ['set -x', 'set -e', 'export LC_ALL=C', 'source /common.sh', 'install_cleanup_trap']
-    
-    try:
-        scripts_path = Path(build_dir, 'scripts').resolve()
-        for script in scripts_path.glob('*.sh'):
-            with open(script, 'r') as f:
-                lines = [line for line in f.readlines() 
-                        if not any(pattern in line for pattern in patterns)]
-            
-            with open(script, 'w') as f:
-                f.writelines(lines)
-    except IOError as e:
-        raise RuntimeError(f"Failed to clean scripts: {e}")
-
 def run_script(script_path: Path, env_vars: Dict[str, str]) -> bool:
     """Execute a single script with the given environment variables"""
     if not script_path.exists():
@@ -76,43 +79,57 @@ def run_script(script_path: Path, env_vars: Dict[str, str]) -> bool:
         click.echo(f"Error executing {script_path.name}: {e}", err=True)
         return False
 
-def get_ordered_scripts(scripts_dir: str) -> List[str]:
+def get_ordered_scripts(scripts_path: Path) -> List[str]:
     """Get all shell scripts in numerical order"""
     try:
-        return sorted(script.name for script in Path(scripts_dir).glob('[0-9][0-9]-*.sh'))
+        return sorted(script.name for script in scripts_path.glob('[0-9][0-9]-*.sh'))
     except OSError as e:
         raise RuntimeError(f"Failed to get ordered scripts: {e}")
 
-def replace_files_path(build_dir: str) -> None:
-    """Replace /files with absolute path to files directory in all shell scripts"""
+# Lines containing any of these are dropped from the scripts
+CLEAN_PATTERNS = ['set -x', 'set -e', 'export LC_ALL=C', 'source /common.sh', 'install_cleanup_trap']
+
+# Matches a whole line to drop, or a /files path reference to rewrite
+SCRIPT_PATTERN = re.compile(
+    r'^[^\n]*(?:' + '|'.join(re.escape(p) for p in CLEAN_PATTERNS) + r')[^\n]*\n?'
+    r'|/files(?=[/ "\'])',
+    re.MULTILINE
+)
+
+def prepare_scripts(build_path: Path) -> None:
+    """Remove specified lines from shell scripts and replace /files with the absolute files path"""
     try:
-        scripts_path = Path(build_dir, 'scripts').resolve()
-        files_path = Path(build_dir, 'files').resolve()
+        scripts_path = build_path / 'scripts'
+        files_path = str(build_path / 'files')
+        
+        def substitute(match: re.Match) -> str:
+            return files_path if match.group(0) == '/files' else ''
         
         for script in scripts_path.glob('*.sh'):
             with open(script, 'r') as f:
                 content = f.read()
             
-            # Replace with absolute path to files directory
-            modified_content = content.replace('/files/', f'{files_path}/')
-            modified_content = modified_content.replace('/files ', f'{files_path} ')
-            modified_content = modified_content.replace('/files"', f'{files_path}"')
-            modified_content = modified_content.replace("/files'", f"{files_path}'")
-            
             with open(script, 'w') as f:
-                f.write(modified_content)
+                f.write(SCRIPT_PATTERN.sub(substitute, content))
     except IOError as e:
-        raise RuntimeError(f"Failed to replace files paths: {e}")
+        raise RuntimeError(f"Failed to prepare scripts: {e}")
+
+# Number of threads used to chmod files in the build directory
+CHMOD_WORKERS = 32
 
-def make_files_readable(build_dir: str) -> None:
+def make_files_readable(build_path: Path) -> None:
     """Make all files in build directory readable by all users"""
     try:
-        build_path = Path(build_dir).resolve()
+        file_paths = []
         for root, dirs, files in os.walk(build_path):
+            # Directories are fixed up before os.walk descends into them
             for d in dirs:
-                Path(root, d).chmod(0o755)  # rwxr-xr-x for directories
-            for f in files:
-                Path(root, f).chmod(0o644)  # rw-r--r-- for files
+                os.chmod(os.path.join(root, d), 0o755)  # rwxr-xr-x for directories
+            file_paths.extend(os.path.join(root, f) for f in files)
+        
+        # chmod releases the GIL, so file permissions are set in parallel
+        with ThreadPoolExecutor(max_workers=CHMOD_WORKERS) as executor:
+            list(executor.map(lambda path: os.chmod(path, 0o644), file_paths))  # rw-r--r-- for files
     except OSError as e:
         raise RuntimeError(f"Failed to make files readable: {e}")
 
@@ -134,30 +151,27 @@ def main(scripts_dir: str, temp_dir: str, dry_run: bool, scripts: Optional[tuple
         if not scripts_dir or not temp_dir:
             raise click.UsageError("--scripts-dir and --temp-dir are required arguments")
 
-        # Resolve absolute paths
-        scripts_dir = str(Path(scripts_dir).resolve())
-        temp_dir = str(Path(temp_dir).resolve())
+        # Resolve absolute paths once and pass them through
+        scripts_path = Path(scripts_dir).resolve()
+        build_path = Path(temp_dir).resolve()
 
         env_vars = {
             **os.environ,
         }
         
         click.echo("Setting up build environment...")
-        setup_build_dir(temp_dir)
+        setup_build_dir(build_path)
         
         click.echo("Copying scripts...")
-        copy_scripts(scripts_dir, temp_dir)
-        
-        click.echo("Cleaning scripts...")
-        clean_scripts(temp_dir)
+        copy_scripts(scripts_path, build_path)
         
-        click.echo("Replacing files paths...")
-        replace_files_path(temp_dir)
+        click.echo("Cleaning scripts and replacing files paths...")
+        prepare_scripts(build_path)
         
         click.echo("Making files readable...")
-        make_files_readable(temp_dir)
+        make_files_readable(build_path)
         
-        scripts_to_run = list(scripts) if scripts else get_ordered_scripts(scripts_dir)
+        scripts_to_run = list(scripts) if scripts else get_ordered_scripts(scripts_path)
         
         if dry_run:
             click.echo("\nDry Run - Would Execute These Scripts:")
@@ -166,7 +180,7 @@ def main(scripts_dir: str, temp_dir: str, dry_run: bool, scripts: Optional[tuple
             return
         
         for script in scripts_to_run:
-            script_path = Path(temp_dir) / 'scripts' / script
+            script_path = build_path / 'scripts' / script
             if not run_script(script_path, env_vars):
                 raise RuntimeError(f"Failed to execute {script}")
         
@@ -8,7 +8,7 @@ install_cleanup_trap
 
 
 # Install Python dependencies
-apt install python3-cryptography python3-asn1crypto
+apt install python3-cryptography
 
 # Copy attestation daemon script
 cp /files/attestation_daemon.py /usr/local/bin/attestation_daemon.py
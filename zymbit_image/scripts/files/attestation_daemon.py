@@ -14,22 +14,36 @@ import os
 import time
 import hashlib
 import base64
+import mmap
+import itertools
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ed25519
 from cryptography.exceptions import InvalidKey
-from asn1crypto.core import Sequence, OctetString, UTF8String
 
 # Path for the UNIX domain socket (should match the QEMU command line)
 SOCKET_PATH = "/tmp/org.causality.attestation"
 
 # Base directory where received files will be stored.
-# Files and their signatures will be placed in a folder named after the current Unix timestamp.
+# Files and their signatures will be placed in a folder named after the Unix timestamp at which
+# the daemon started, each prefixed with a sequence number.
 OUTPUT_BASE_DIR = "/var/lib/attestation_results"
 
 # File to store/load Ed25519 private key
 SIGNING_KEY_PATH = "/var/lib/pcr_attestation_keys/signing_key.pem"
 
+# Buffer size for writing received files (Python's default is 8 KiB)
+FILE_BUFFER_SIZE = 256 * 1024
+
+# Received files at least this large are written with O_DIRECT, bypassing the page cache
+DIRECT_IO_THRESHOLD = 1024 * 1024
+
+# O_DIRECT requires buffer addresses, offsets and lengths aligned to the block size
+DIRECT_IO_ALIGNMENT = 4096
+
 ###############################################################################
 # ERROR HANDLING
 ###############################################################################
@@ -39,6 +53,28 @@ class AttestationDaemonError(Exception):
     pass
 
 
+###############################################################################
+# SMALL FILE WRITES
+###############################################################################
+
+def write_small_file(path: str, data: bytes) -> None:
+    """
+    Write a small file (signature, public key) with a single os.write,
+    skipping the setup of Python's buffered I/O layer.
+
+    :param path: Path of the file to create or truncate.
+    :param data: The bytes to write.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        with memoryview(data) as view:
+            written = 0
+            while written < len(view):
+                written += os.write(fd, view[written:])
+    finally:
+        os.close(fd)
+
+
 ###############################################################################
 # KEY MANAGEMENT
 ###############################################################################
@@ -60,18 +96,24 @@ def save_private_key(private_key: ed25519.Ed25519PrivateKey, key_path: str) -> N
 def save_public_key(public_key: ed25519.Ed25519PublicKey, output_dir: str) -> None:
     """
     Save an Ed25519 public key to the attestation results directory in PEM format.
+    The file is left untouched if it already holds this public key.
     
     :param public_key: The Ed25519 public key to save
     :param output_dir: Directory where the public key will be stored
     """
     os.makedirs(output_dir, exist_ok=True)
     public_key_path = os.path.join(output_dir, "signing_key.pub.pem")
+    public_key_pem = public_key.public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
     
-    with open(public_key_path, "wb") as pub_key_file:
-        pub_key_file.write(public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        ))
+    if os.path.exists(public_key_path):
+        with open(public_key_path, "rb") as pub_key_file:
+            if pub_key_file.read() == public_key_pem:
+                return
+    
+    write_small_file(public_key_path, public_key_pem)
 
 def get_signing_key(key_path: str = SIGNING_KEY_PATH) -> ed25519.Ed25519PrivateKey:
     """
@@ -105,21 +147,26 @@ def get_signing_key(key_path: str = SIGNING_KEY_PATH) -> ed25519.Ed25519PrivateK
 # SOCKET HANDLING
 ###############################################################################
 
-def recvall(sock: socket.socket, count: int) -> bytes:
+def recvall(sock: socket.socket, count: int, hasher=None) -> bytearray:
     """
-    Receive exactly 'count' bytes from the socket.
+    Receive exactly 'count' bytes from the socket into a preallocated buffer.
 
     :param sock: The socket to receive from.
     :param count: The exact number of bytes to read.
+    :param hasher: Optional hashlib object fed each chunk as it arrives.
     :returns: The bytes read.
     :raises RuntimeError: If the socket closes prematurely.
     """
-    buf = b""
-    while len(buf) < count:
-        chunk = sock.recv(count - len(buf))
-        if not chunk:
-            raise RuntimeError("Socket connection closed prematurely.")
-        buf += chunk
+    buf = bytearray(count)
+    with memoryview(buf) as view:
+        offset = 0
+        while offset < count:
+            n = sock.recv_into(view[offset:], count - offset)
+            if not n:
+                raise RuntimeError("Socket connection closed prematurely.")
+            if hasher is not None:
+                hasher.update(view[offset:offset + n])
+            offset += n
     return buf
 
 
@@ -127,91 +174,150 @@ def recvall(sock: socket.socket, count: int) -> bytes:
 # FILE CONTAINER
 ###############################################################################
 
-class FileContainer(Sequence):
-    _fields = [
-        ('filename', UTF8String),
-        ('data', OctetString)
-    ]
+# Filename length (2 bytes) and data length (4 bytes), both big-endian,
+# followed by the UTF-8 filename and the file data.
+FILE_CONTAINER_HEADER = struct.Struct("!HI")
 
 # Encoding
 def create_file_container(filename: str, data: bytes) -> bytes:
-    container = FileContainer({
-        'filename': filename,
-        'data': data
-    })
-    return container.dump()
-
-# Decoding
-def parse_file_container(der_bytes: bytes) -> tuple[str, bytes]:
-    container = FileContainer.load(der_bytes)
-    return (
-        container['filename'].native,
-        container['data'].native
-    )
+    name = filename.encode("utf-8")
+    return FILE_CONTAINER_HEADER.pack(len(name), len(data)) + name + data
 
 
 ###############################################################################
 # FILE HANDLING
 ###############################################################################
 
-def handle_file_data(
-    conn: socket.socket,
-    output_base_dir: str,
-    signing_key: ed25519.Ed25519PrivateKey
-) -> None:
+def write_file_direct(file_path: str, data: bytes) -> None:
+    """
+    Write data to a file with O_DIRECT, bypassing the page cache.
+
+    The data is copied into a page-aligned buffer padded to the block size,
+    and the file is truncated back to the real length afterwards.
+
+    :param file_path: Path of the file to create.
+    :param data: The bytes to write.
+    :raises OSError: If the filesystem does not support O_DIRECT.
+    """
+    aligned_length = -(-len(data) // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+    buf = mmap.mmap(-1, aligned_length)
+    try:
+        buf[:len(data)] = data
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+        try:
+            with memoryview(buf) as view:
+                written = 0
+                while written < aligned_length:
+                    written += os.writev(fd, [view[written:]])
+            os.ftruncate(fd, len(data))
+        finally:
+            os.close(fd)
+    finally:
+        buf.close()
+
+
+def save_file_data(file_path: str, data: bytes) -> None:
     """
-    Receive DER-encoded file data, save it to a timestamped directory,
-    compute its hash, and sign it using the provided Ed25519 private key.
+    Write received file data to disk, using direct I/O for large files.
+
+    :param file_path: Path of the file to create.
+    :param data: The bytes to write.
+    """
+    if len(data) >= DIRECT_IO_THRESHOLD and hasattr(os, "O_DIRECT"):
+        try:
+            write_file_direct(file_path, data)
+            return
+        except OSError as exc:
+            print(f"[Warning] Direct I/O write failed, falling back to buffered write: {exc}")
+
+    with open(file_path, "wb", buffering=FILE_BUFFER_SIZE) as f:
+        f.write(data)
+
+
+def receive_file_container(conn: socket.socket) -> tuple[str, bytes, str] | None:
+    """
+    Receive one length-prefixed file container from the connection, hashing
+    the file data as it arrives.
+
+    :param conn: The connected socket.
+    :returns: The (filename, file data, BLAKE2b-256 hex digest) triple, or None
+              if the peer closed the connection before starting a new container.
+    :raises AttestationDaemonError: If the container header is inconsistent.
     """
     # First read the total length (4 bytes)
-    length_bytes = recvall(conn, 4)
+    length_bytes = conn.recv(4)
+    if not length_bytes:
+        return None
+    length_bytes += recvall(conn, 4 - len(length_bytes))
     total_length = struct.unpack("!I", length_bytes)[0]
     
-    # Read the DER-encoded data
-    der_data = recvall(conn, total_length)
+    # Read the container header and the filename
+    if total_length < FILE_CONTAINER_HEADER.size:
+        raise AttestationDaemonError("File container is shorter than its header.")
+    name_length, data_length = FILE_CONTAINER_HEADER.unpack(
+        recvall(conn, FILE_CONTAINER_HEADER.size))
+    if FILE_CONTAINER_HEADER.size + name_length + data_length != total_length:
+        raise AttestationDaemonError("File container length does not match its header.")
+    filename = recvall(conn, name_length).decode("utf-8")
     
-    # Parse the DER container
-    filename, file_data = parse_file_container(der_data)
+    # Read the file data, hashing each chunk while it is still in cache
+    # (BLAKE2b-256, for logging/debugging only, not part of the protocol)
+    hasher = hashlib.blake2b(digest_size=32)
+    file_data = recvall(conn, data_length, hasher)
+    return filename, bytes(file_data), hasher.hexdigest()
 
-    timestamp = str(int(time.time()))
-    output_dir = os.path.join(output_base_dir, timestamp)
-    os.makedirs(output_dir, exist_ok=True)
 
-    file_path = os.path.join(output_dir, filename)
-    with open(file_path, "wb") as f:
-        f.write(file_data)
+def handle_file_data(
+    filename: str,
+    file_data: bytes,
+    file_hash: str,
+    output_dir: str,
+    seq: int,
+    sign: Callable[[bytes], bytes]
+) -> None:
+    """
+    Save a received file to the output directory under its sequence number,
+    log its hash, and sign it using the provided Ed25519 signing function.
+    """
+    file_path = os.path.join(output_dir, f"{seq:08d}_{filename}")
+    save_file_data(file_path, file_data)
 
     print(f"Received file: {filename} ({len(file_data)} bytes) -> {file_path}")
 
-    # Compute SHA-256 hash (for logging/debugging)
-    file_hash = hashlib.sha256(file_data).hexdigest()
-    print("SHA256:", file_hash)
+    print("BLAKE2b-256:", file_hash)
 
     # Sign the file
-    signature = signing_key.sign(file_data)
+    signature = sign(file_data)
     signature_b64 = base64.b64encode(signature)
 
     signature_path = file_path + ".sig"
-    with open(signature_path, "wb") as sig_file:
-        sig_file.write(signature_b64)
+    write_small_file(signature_path, signature_b64)
 
     print("Signature written to:", signature_path)
 
 
 def handle_connection(
     conn: socket.socket,
-    output_base_dir: str,
-    signing_key: ed25519.Ed25519PrivateKey
+    output_dir: str,
+    sequence: itertools.count,
+    sign: Callable[[bytes], bytes]
 ) -> None:
     """
-    Handle each client connection: parse header, receive file, sign.
+    Handle each client connection: receive file containers until the peer
+    disconnects, saving and signing each file as soon as it arrives.
 
     :param conn: Connected socket from accept().
-    :param output_base_dir: Base directory for output.
-    :param signing_key: Ed25519 private key used to sign the file data.
+    :param output_dir: Directory for this daemon run's output.
+    :param sequence: Counter supplying each file's sequence number.
+    :param sign: Ed25519 signing function applied to the file data.
     """
     try:
-        handle_file_data(conn, output_base_dir, signing_key)
+        while True:
+            file_container = receive_file_container(conn)
+            if file_container is None:
+                break
+            filename, file_data, file_hash = file_container
+            handle_file_data(filename, file_data, file_hash, output_dir, next(sequence), sign)
     except AttestationDaemonError as exc:
         print(f"[Error] Protocol error: {exc}")
     except Exception as exc:
@@ -220,13 +326,35 @@ def handle_connection(
         conn.close()
 
 
+def create_run_dir(output_base_dir: str) -> str:
+    """
+    Create a fresh directory for this daemon run, named after the current
+    Unix timestamp. An existing directory is never reused, so a restart
+    within the same second cannot overwrite already-signed results.
+
+    :param output_base_dir: Base directory to store files and signatures.
+    :returns: Path of the newly created directory.
+    """
+    os.makedirs(output_base_dir, exist_ok=True)
+    timestamp = str(int(time.time()))
+    output_dir = os.path.join(output_base_dir, timestamp)
+    suffix = 0
+    while True:
+        try:
+            os.mkdir(output_dir)
+            return output_dir
+        except FileExistsError:
+            suffix += 1
+            output_dir = os.path.join(output_base_dir, f"{timestamp}_{suffix}")
+
+
 def run_server(
     socket_path: str = SOCKET_PATH,
     output_base_dir: str = OUTPUT_BASE_DIR
 ) -> None:
     """
     Main loop: create a server socket, accept connections,
-    and process them using handle_connection.
+    and process them concurrently using handle_connection.
 
     :param socket_path: Path for the Unix domain socket.
     :param output_base_dir: Base directory to store files and signatures.
@@ -235,22 +363,59 @@ def run_server(
     if os.path.exists(socket_path):
         os.remove(socket_path)
 
+    # Load the key once and hand the bound sign method to the workers
     signing_key = get_signing_key()
+    sign = signing_key.sign
+
+    # Everything received during this run goes into one directory, with a
+    # shared counter keeping file names unique across connections.
+    output_dir = create_run_dir(output_base_dir)
+    sequence = itertools.count()
 
     server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     server.bind(socket_path)
     server.listen(5)
     print(f"Listening on {socket_path}")
 
+    # Handle connections on worker threads so a large file being written or
+    # signed does not hold up the accept loop.
+    max_workers = os.cpu_count() or 1
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    # Accepted connections not yet finished, so shutdown can unblock their recv().
+    active_conns: set[socket.socket] = set()
+    active_lock = threading.Lock()
+
+    def release(conn: socket.socket) -> None:
+        with active_lock:
+            active_conns.discard(conn)
+        conn.close()
+
     try:
         while True:
             conn, _ = server.accept()
             print("Accepted connection.")
-            handle_connection(conn, output_base_dir, signing_key)
+            with active_lock:
+                all_busy = len(active_conns) >= max_workers
+                active_conns.add(conn)
+            if all_busy:
+                print(f"[Warning] All {max_workers} workers are busy; "
+                      "connection will wait until one is free.")
+            future = pool.submit(handle_connection, conn, output_dir, sequence, sign)
+            future.add_done_callback(lambda _, conn=conn: release(conn))
     except KeyboardInterrupt:
         print("Shutting down server.")
     finally:
         server.close()
+        # Workers block in recv() until the peer disconnects; shutting the
+        # sockets down makes them see end-of-stream and return.
+        with active_lock:
+            for conn in active_conns:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        pool.shutdown(wait=True, cancel_futures=True)
         if os.path.exists(socket_path):
             os.remove(socket_path)
 